@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+#
+# Scale Profile Builder for the Music Key Detection Script
+# Author: Manuel Rueda, PhD (2024)
+# License: MIT License
+#
+# Regenerate profiles.npy after editing CHROMATIC_SCALE or SCALES:
+#   python3 build_profiles.py
+
+import numpy as np
+import os
+
+# Define scales
+CHROMATIC_SCALE = ['C', 'C#', 'D', 'D#', 'E', 'F',
+                  'F#', 'G', 'G#', 'A', 'A#', 'B']
+NOTE_IDX = {note: i for i, note in enumerate(CHROMATIC_SCALE)}
+SCALES = {
+    "Major": [2, 2, 1, 2, 2, 2, 1],
+    "Natural Minor": [2, 1, 2, 2, 1, 2, 2],
+    "Harmonic Minor": [2, 1, 2, 2, 1, 3, 1],
+    "Melodic Minor": [2, 1, 2, 2, 2, 2, 1],
+    "Dorian": [2, 1, 2, 2, 2, 1, 2],
+    "Phrygian": [1, 2, 2, 2, 1, 2, 2],
+    "Lydian": [2, 2, 2, 1, 2, 2, 1],
+    "Mixolydian": [2, 2, 1, 2, 2, 1, 2],
+    "Locrian": [1, 2, 2, 1, 2, 2, 2]
+}
+
+# One row per (root, scale) pair, with the chromatic index of each root and the
+# definition-order index of each scale for tie-breaking
+PROFILE_LABELS = [(root, scale_name)
+                  for root in CHROMATIC_SCALE for scale_name in SCALES]
+PROFILE_ROOT_IDX = np.array([NOTE_IDX[root] for root, _ in PROFILE_LABELS])
+PROFILE_SCALE_IDX = np.array([list(SCALES).index(scale_name) for _, scale_name in PROFILE_LABELS])
+
+# Precomputed profile matrix shipped next to the scripts
+PROFILES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'profiles.npy')
+
+# Generate scale profiles
+def generate_scale(root, intervals):
+    scale = [root]
+    index = NOTE_IDX[root]
+    for step in intervals:
+        index = (index + step) % len(CHROMATIC_SCALE)
+        scale.append(CHROMATIC_SCALE[index])
+    return scale
+
+def pitch_class_profile(scale):
+    profile = np.zeros(12)
+    for note in scale:
+        profile[NOTE_IDX[note]] = 1
+    return profile / profile.sum()
+
+# Generate profiles for all scales as one contiguous (108, 12) float32 matrix
+def build_profile_matrix():
+    return np.ascontiguousarray(
+        np.stack([pitch_class_profile(generate_scale(root, SCALES[scale_name]))
+                  for root, scale_name in PROFILE_LABELS]),
+        dtype=np.float32)
+
+if __name__ == "__main__":
+    np.save(PROFILES_FILE, build_profile_matrix())
+    print(f"Profiles saved as {PROFILES_FILE}")
@@ -5,78 +5,95 @@
 # License: MIT License
 
 import numpy as np
-import pandas as pd
 from scipy.io import wavfile
+from scipy.signal import resample_poly
 from scipy.signal.windows import hann
+from scipy.fft import rfft, rfftfreq, next_fast_len, set_workers
+import soundfile as sf
 from pydub import AudioSegment
 import os
-import matplotlib.pyplot as plt
+import functools
 import sys
 import argparse
+from build_profiles import (CHROMATIC_SCALE, PROFILE_LABELS, PROFILE_ROOT_IDX, PROFILE_SCALE_IDX,
+                            PROFILES_FILE, build_profile_matrix)
 
-# Define scales
-CHROMATIC_SCALE = ['C', 'C#', 'D', 'D#', 'E', 'F',
-                  'F#', 'G', 'G#', 'A', 'A#', 'B']
-SCALES = {
-    "Major": [2, 2, 1, 2, 2, 2, 1],
-    "Natural Minor": [2, 1, 2, 2, 1, 2, 2],
-    "Harmonic Minor": [2, 1, 2, 2, 1, 3, 1],
-    "Melodic Minor": [2, 1, 2, 2, 2, 2, 1],
-    "Dorian": [2, 1, 2, 2, 2, 1, 2],
-    "Phrygian": [1, 2, 2, 2, 1, 2, 2],
-    "Lydian": [2, 2, 2, 1, 2, 2, 1],
-    "Mixolydian": [2, 2, 1, 2, 2, 1, 2],
-    "Locrian": [1, 2, 2, 1, 2, 2, 2]
-}
+# Optional: JIT-compiled STFT accumulator (rocket_fft registers np.fft with Numba)
+try:
+    import rocket_fft  # noqa: F401
+    from numba import njit, prange, get_num_threads
+except ImportError:
+    njit = None
 
 # Define which scales are considered keys and which are modes
 KEY_SCALES = ["Major", "Natural Minor", "Harmonic Minor", "Melodic Minor"]
 MODE_SCALES = ["Dorian", "Phrygian", "Lydian", "Mixolydian", "Locrian"]
 
-# Generate scale profiles
-def generate_scale(root, intervals):
-    scale = [root]
-    index = CHROMATIC_SCALE.index(root)
-    for step in intervals:
-        index = (index + step) % len(CHROMATIC_SCALE)
-        scale.append(CHROMATIC_SCALE[index])
-    return scale
-
-def pitch_class_profile(scale):
-    df = pd.DataFrame({'Note': CHROMATIC_SCALE, 'Value': np.zeros(12)})
-    for note in scale:
-        df.loc[df['Note'] == note, 'Value'] = 1
-    return df['Value'].values / df['Value'].sum()
-
-# Generate profiles for all scales
-scale_profiles = {
-    scale_name: [pitch_class_profile(generate_scale(note, intervals))
-                for note in CHROMATIC_SCALE]
-    for scale_name, intervals in SCALES.items()
-}
-
-# Function to convert MP3 or other formats to WAV
-def convert_to_wav(input_file):
+# FFT window length in samples at the input sample rate (scaled down with the
+# audio when it is downsampled, and rounded up to a fast FFT size at runtime)
+WINDOW_SIZE = 4096
+
+# Sample rate the audio is analysed at with --downsample; the PCP only uses bins
+# up to 5 kHz, which this rate's Nyquist frequency (5512.5 Hz) still covers
+ANALYSIS_SAMPLE_RATE = 11025
+
+# Number of frames windowed and transformed together by the batched FFT
+FRAMES_PER_BLOCK = 256
+
+# Load the precomputed (108, 12) profile matrix, rebuilding it if the file is
+# missing, unreadable or has the wrong shape or dtype. The values themselves are
+# not checked here; the test suite compares them against build_profile_matrix()
+def load_profile_matrix():
+    try:
+        matrix = np.load(PROFILES_FILE, mmap_mode='r')
+        if matrix.shape == (len(PROFILE_LABELS), 12) and matrix.dtype == np.float32:
+            return matrix
+    except (OSError, ValueError):
+        pass
+    return build_profile_matrix()
+
+PROFILE_MATRIX = load_profile_matrix()
+
+# Decode MP3, OGG, FLAC or other formats straight to PCM samples (no temporary WAV file)
+def decode_audio(input_file):
+    try:
+        # libsndfile decodes in-process; no ffmpeg subprocess
+        data, sample_rate = sf.read(input_file, dtype='float32', always_2d=False)
+        return sample_rate, data
+    except sf.LibsndfileError:
+        pass  # e.g. MP3 with a libsndfile built without MPEG support
     audio = AudioSegment.from_file(input_file)
-    output_file = "temp_audio.wav"
-    audio.export(output_file, format="wav")
-    return output_file
+    samples = np.array(audio.get_array_of_samples())
+    if audio.channels > 1:
+        samples = samples.reshape(-1, audio.channels)  # Same layout as wavfile.read
+    return audio.frame_rate, samples
 
 # Ensure the audio file exists and is valid
 def load_audio(file_path):
-    if file_path.endswith(".mp3") or file_path.endswith(".ogg"):
-        file_path = convert_to_wav(file_path)
-    sample_rate, data = wavfile.read(file_path)
-    if len(data.shape) > 1:
-        data = data[:, 0]  # Use the first channel for stereo audio
+    if file_path.lower().endswith(".wav"):
+        # Memory-map the file so unused channels are never paged in
+        try:
+            sample_rate, data = wavfile.read(file_path, mmap=True)
+        except ValueError:
+            # SciPy cannot memory-map some sample widths (e.g. 24-bit PCM)
+            sample_rate, data = wavfile.read(file_path)
+    else:
+        sample_rate, data = decode_audio(file_path)
+    if data.ndim > 1:
+        data = np.ascontiguousarray(data[:, 0])  # Use the first channel for stereo audio
+    # Work in float32: half the memory traffic of float64 for the FFT stage
+    data = data.astype(np.float32, copy=False)
+    peak = np.max(np.abs(data))
     # Avoid division by zero
-    if np.max(np.abs(data)) == 0:
+    if peak == 0:
         return sample_rate, data
-    data = data / np.max(np.abs(data))  # Normalize audio
+    data = data * (1.0 / peak)  # Normalize audio
     return sample_rate, data
 
 # Plot the FFT magnitude spectrum with notes on a secondary axis
 def plot_fft_with_note_axis(frequencies, magnitude, plot_name):
+    import matplotlib.pyplot as plt  # Imported lazily: only needed with --plot
+
     plt.figure(figsize=(12, 7))
     plt.plot(frequencies, magnitude, color='blue', label='FFT Magnitude')
     plt.title('FFT Magnitude Spectrum with Notes')
@@ -85,21 +102,20 @@ def plot_fft_with_note_axis(frequencies, magnitude, plot_name):
     plt.grid(True)
 
     # Map frequencies to notes for the secondary axis
-    displayed_notes = []
-    for freq in frequencies:
-        if 20 <= freq <= 20000:  # Only process within a musical range
-            midi = 69 + 12 * np.log2(freq / 440.0)
-            pitch_class = int(round(midi)) % 12
-            note = CHROMATIC_SCALE[pitch_class]
-            if not displayed_notes or freq - displayed_notes[-1][0] > 1000:
-                displayed_notes.append((freq, note))
+    mask = (frequencies >= 20) & (frequencies <= 20000)  # Only process within a musical range
+    note_freqs = frequencies[mask]
+    # Label the first bin of every 1000 Hz bucket
+    _, first_in_bucket = np.unique(np.floor(note_freqs / 1000).astype(np.int64), return_index=True)
+    tick_freqs = note_freqs[first_in_bucket]
+    pitch_classes = np.rint(69 + 12 * np.log2(tick_freqs / 440.0)).astype(np.int64) % 12
+    tick_notes = np.array(CHROMATIC_SCALE)[pitch_classes]
 
     # Add a secondary axis with spaced notes
     ax = plt.gca()
     ax2 = ax.twiny()
     ax2.set_xlim(ax.get_xlim())
-    ax2.set_xticks([item[0] for item in displayed_notes])
-    ax2.set_xticklabels([item[1] for item in displayed_notes], fontsize=10, rotation=45)
+    ax2.set_xticks(tick_freqs)
+    ax2.set_xticklabels(tick_notes, fontsize=10, rotation=45)
     ax2.set_xlabel('Notes')
 
     if plot_name:
@@ -107,15 +123,72 @@ def plot_fft_with_note_axis(frequencies, magnitude, plot_name):
         print(f"Plot saved as {plot_name}")
     else:
         plt.show()
+    plt.close()
 
-# Map FFT magnitudes to pitch classes
-def compute_pitch_class_profile(frequencies, magnitude):
-    pitch_class_profile = np.zeros(12)
-    for i, freq in enumerate(frequencies):
-        if 20 <= freq <= 5000:
-            midi = 69 + 12 * np.log2(freq / 440.0)
-            pitch_class = int(round(midi)) % 12
-            pitch_class_profile[pitch_class] += magnitude[i]
+# Sum the FFT magnitudes of all overlapping windows inside one parallel Numba loop
+if njit is not None:
+    @njit(parallel=True, fastmath=True)
+    def stft_magsum(data, window, window_size, step_size, bin_lo, bin_hi):
+        num_windows = (len(data) - window_size + step_size - 1) // step_size
+        num_threads = get_num_threads()
+        chunk = (num_windows + num_threads - 1) // num_threads
+        # One accumulator row per thread, reduced at the end
+        partial = np.zeros((num_threads, bin_hi - bin_lo))
+        for t in prange(num_threads):
+            segment = np.empty(window_size)
+            for w in range(t * chunk, min((t + 1) * chunk, num_windows)):
+                start = w * step_size
+                for k in range(window_size):
+                    segment[k] = data[start + k] * window[k]
+                fft = np.fft.rfft(segment)
+                for k in range(bin_lo, bin_hi):
+                    partial[t, k - bin_lo] += np.abs(fft[k])
+        return partial.sum(axis=0)
+
+# Sum the FFT magnitudes of all overlapping windows in a single batched call,
+# accumulating only the requested slice of frequency bins
+def compute_magnitude_spectrum(data, window, step_size, bins=slice(None), jit=False):
+    window_size = len(window)
+    bin_lo, bin_hi, _ = bins.indices(window_size // 2 + 1)
+    magnitude = np.zeros(bin_hi - bin_lo)
+    if len(data) <= window_size:
+        return magnitude
+    if jit:
+        return stft_magsum(data, window, window_size, step_size, bin_lo, bin_hi)
+    # Strided view of the windows starting at 0, step_size, ... (no copy)
+    windows = np.lib.stride_tricks.sliding_window_view(data, window_size)
+    windows = windows[:len(data) - window_size:step_size]
+    # Buffers allocated once and reused for every block of frames, so the
+    # working set stays bounded however long the input is
+    block_size = min(FRAMES_PER_BLOCK, len(windows))
+    frames = np.empty((block_size, window_size), dtype=np.float32)
+    frame_magnitude = np.empty((block_size, bin_hi - bin_lo), dtype=np.float32)
+    # One 2D transform per block, threaded across all cores
+    with set_workers(os.cpu_count()):
+        for first in range(0, len(windows), block_size):
+            block = windows[first:first + block_size]
+            np.multiply(block, window, out=frames[:len(block)])
+            spectrum = rfft(frames[:len(block)], axis=1, overwrite_x=True)
+            np.abs(spectrum[:, bin_lo:bin_hi], out=frame_magnitude[:len(block)])
+            magnitude += frame_magnitude[:len(block)].sum(axis=0)
+    return magnitude
+
+# Map FFT bins (20-5000 Hz) to pitch classes; depends only on the FFT parameters.
+# Returns the slice of bins in that range and the pitch class of each of them.
+@functools.lru_cache(maxsize=8)
+def _pc_bins(window_size, sample_rate):
+    frequencies = rfftfreq(window_size, d=1 / sample_rate)
+    bin_lo = np.searchsorted(frequencies, 20, side='left')
+    bin_hi = np.searchsorted(frequencies, 5000, side='right')
+    midi = 69 + 12 * np.log2(frequencies[bin_lo:bin_hi] / 440.0)
+    pc_idx = np.rint(midi).astype(np.int64) % 12
+    pc_idx.setflags(write=False)  # The cached array is shared between calls
+    return slice(int(bin_lo), int(bin_hi)), pc_idx
+
+# Map FFT magnitudes of the 20-5000 Hz bins (see _pc_bins) to pitch classes
+def compute_pitch_class_profile(magnitude, window_size, sample_rate):
+    _, pc_idx = _pc_bins(window_size, sample_rate)
+    pitch_class_profile = np.bincount(pc_idx, weights=magnitude, minlength=12)
     # Avoid division by zero
     total = np.sum(pitch_class_profile)
     if total == 0:
@@ -125,40 +198,43 @@ def compute_pitch_class_profile(frequencies, magnitude):
 # Parse command-line arguments
 def parse_arguments():
     parser = argparse.ArgumentParser(description="Detect the musical key or mode of an audio file.")
-    parser.add_argument('audio_file', type=str, help='Path to the input audio file (WAV, MP3, OGG).')
+    parser.add_argument('audio_file', type=str, help='Path to the input audio file (WAV, MP3, OGG, FLAC).')
     parser.add_argument('--plot', type=str, default=None, help='Optional: Path to save the FFT plot image.')
     parser.add_argument('--show-scores', action='store_true',
                         help='Optional: If set, print all key and mode scores sorted by score.')
+    parser.add_argument('--jit', action='store_true',
+                        help='Optional: If set, compute the FFT with a Numba JIT-compiled loop (requires numba and rocket-fft).')
+    parser.add_argument('--downsample', action='store_true',
+                        help=f'Optional: If set, resample the audio to {ANALYSIS_SAMPLE_RATE} Hz before the FFT.')
     return parser.parse_args()
 
-# Main function
-def main():
-    args = parse_arguments()
-    
-    audio_file = args.audio_file
-    plot_name = args.plot
-    show_scores = args.show_scores
-    
-    if not os.path.exists(audio_file):
-        print(f"Error: '{audio_file}' not found.")
-        sys.exit(1)
+# Detect the key or mode of an audio file and return the "Detected ..." line
+def detect_key(audio_file, plot=None, show_scores=False, jit=False, downsample=False):
+    if jit and njit is None:
+        print("Warning: numba and rocket-fft are not installed, falling back to the batched FFT.")
+        jit = False
     
     # Load the audio file
     sample_rate, data = load_audio(audio_file)
     
-    # FFT parameters
-    window_size = 4096
-    step_size = 2048  # Overlap of 50%
-    hanning_window = hann(window_size, sym=False)
+    # Downsample to the analysis rate, shrinking the window with it so the
+    # frequency resolution stays the same (4096 samples at 44.1 kHz -> 1024)
+    window_length = WINDOW_SIZE
+    if downsample and sample_rate > ANALYSIS_SAMPLE_RATE:
+        window_length = WINDOW_SIZE * ANALYSIS_SAMPLE_RATE / sample_rate
+        data = resample_poly(data, ANALYSIS_SAMPLE_RATE, sample_rate).astype(np.float32, copy=False)
+        sample_rate = ANALYSIS_SAMPLE_RATE
     
-    # Compute FFT from the audio
-    frequencies = np.fft.rfftfreq(window_size, d=1 / sample_rate)
-    magnitude = np.zeros(len(frequencies))
+    # FFT parameters: round the length up so pocketfft stays on its fast kernels
+    window_size = next_fast_len(int(round(window_length)), real=True)
+    step_size = window_size // 2  # Overlap of 50%
+    hanning_window = hann(window_size, sym=False).astype(np.float32)
     
-    for start in range(0, len(data) - window_size, step_size):
-        segment = data[start:start + window_size] * hanning_window
-        fft = np.fft.rfft(segment)
-        magnitude += np.abs(fft)
+    # Compute FFT from the audio
+    # Only the PCP bins are accumulated unless the full spectrum is plotted
+    pc_bins, _ = _pc_bins(window_size, sample_rate)
+    bins = slice(None) if plot else pc_bins
+    magnitude = compute_magnitude_spectrum(data, hanning_window, step_size, bins, jit)
     
     # Average the magnitude
     num_windows = (len(data) - window_size) // step_size
@@ -168,38 +244,49 @@ def main():
         print("Warning: Not enough data for FFT.")
     
     # Plot FFT if requested
-    plot_fft_with_note_axis(frequencies, magnitude, plot_name)
+    if plot:
+        frequencies = rfftfreq(window_size, d=1 / sample_rate)
+        plot_fft_with_note_axis(frequencies, magnitude, plot)
+        magnitude = magnitude[pc_bins]
     
     # Compute Pitch Class Profile (PCP)
-    pcp_accum = compute_pitch_class_profile(frequencies, magnitude)
+    pcp_accum = compute_pitch_class_profile(magnitude, window_size, sample_rate)
     
     # Scale detection
     if pcp_accum.max() > 0.4:  # Single-tone threshold
         detected_note = CHROMATIC_SCALE[np.argmax(pcp_accum)]
-        print(f"Detected Key: {detected_note} (Single Tone)")
-    else:
-        key_scores = []
-        for scale_name, profiles in scale_profiles.items():
-            for i, profile in enumerate(profiles):
-                score = np.sum(pcp_accum * profile)
-                key_scores.append((CHROMATIC_SCALE[i], scale_name, score))
-        
-        # Sort scores: first by score descending, then by chromatic order ascending
-        key_scores_sorted = sorted(
-            key_scores,
-            key=lambda x: (-x[2], CHROMATIC_SCALE.index(x[0]))
-        )
-        
-        if show_scores:
-            print("\nScores for all keys and modes:")
-            for root, scale_name, score in key_scores_sorted:
-                scale_type = "Key" if scale_name in KEY_SCALES else "Mode"
-                print(f"{scale_type}: {root} {scale_name} - Score: {score:.4f}")
-        
-        # The best key or mode (handling ties by chromatic order)
-        best_key = key_scores_sorted[0]
-        scale_type = "Key" if best_key[1] in KEY_SCALES else "Mode"
-        print(f"\nDetected {scale_type}: {best_key[0]} {best_key[1]}")
+        return f"Detected Key: {detected_note} (Single Tone)"
+    
+    scores = PROFILE_MATRIX @ pcp_accum.astype(np.float32)
+    
+    # Sort scores: first by score descending, then by chromatic order ascending,
+    # then by scale definition order
+    order = np.lexsort((PROFILE_SCALE_IDX, PROFILE_ROOT_IDX, -scores))
+    
+    if show_scores:
+        print("\nScores for all keys and modes:")
+        for i in order:
+            root, scale_name = PROFILE_LABELS[i]
+            scale_type = "Key" if scale_name in KEY_SCALES else "Mode"
+            print(f"{scale_type}: {root} {scale_name} - Score: {scores[i]:.4f}")
+        print()
+    
+    # The best key or mode (handling ties by chromatic order)
+    root, scale_name = PROFILE_LABELS[order[0]]
+    scale_type = "Key" if scale_name in KEY_SCALES else "Mode"
+    return f"Detected {scale_type}: {root} {scale_name}"
+
+# Main function
+def main():
+    args = parse_arguments()
+    
+    if not os.path.exists(args.audio_file):
+        print(f"Error: '{args.audio_file}' not found.")
+        sys.exit(1)
+    
+    result = detect_key(args.audio_file, plot=args.plot, show_scores=args.show_scores, jit=args.jit,
+                        downsample=args.downsample)
+    print(result)
 
 if __name__ == "__main__":
     main()
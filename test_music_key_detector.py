@@ -1,52 +1,76 @@
 import unittest
 import os
-from subprocess import run, PIPE
+import io
+import tempfile
+from contextlib import redirect_stdout
+from unittest import mock
+import numpy as np
+import soundfile as sf
+from build_profiles import PROFILES_FILE, build_profile_matrix
+import music_key_detector
+from music_key_detector import detect_key, compute_magnitude_spectrum, njit, FRAMES_PER_BLOCK
+
+# Expected output for each bundled WAV file
+TONE_RESULTS = {
+    "A#.wav": "Detected Key: A# (Single Tone)",
+    "G#.wav": "Detected Key: G# (Single Tone)",
+    "C#.wav": "Detected Key: C# (Single Tone)",
+    "D.wav": "Detected Key: D (Single Tone)",
+    "F#.wav": "Detected Key: F# (Single Tone)",
+    "G.wav": "Detected Key: G (Single Tone)",
+    "A.wav": "Detected Key: A (Single Tone)",
+    "B.wav": "Detected Key: B (Single Tone)",
+    "F.wav": "Detected Key: F (Single Tone)",
+    "E.wav": "Detected Key: E (Single Tone)",
+    "C.wav": "Detected Key: C (Single Tone)",
+    "D#.wav": "Detected Key: D# (Single Tone)",
+}
+
+SCALE_RESULTS = {
+    # Keys
+    "C_Major.wav": "Detected Key: C Major",
+    "C_Natural Minor.wav": "Detected Key: C Natural Minor",
+    "C_Harmonic Minor.wav": "Detected Key: C Harmonic Minor",
+    "C_Melodic Minor.wav": "Detected Key: C Melodic Minor",
+    # Modes
+    "C_Dorian.wav": "Detected Mode: C Dorian",
+    "C_Phrygian.wav": "Detected Mode: C Phrygian",
+    "C_Lydian.wav": "Detected Mode: C Lydian",
+    "C_Mixolydian.wav": "Detected Mode: C Mixolydian",
+    "C_Locrian.wav": "Detected Mode: C Locrian"
+}
 
 class TestMusicKeyDetector(unittest.TestCase):
     def setUp(self):
         # Directory containing test WAV files
         self.tones_dir = "wavs/tones"
         self.scales_dir = "wavs/scales"
-        self.script = "music_key_detector.py"  # Path to your detector script
 
         # Ensure directories and test files exist
         if not os.path.exists(self.tones_dir) or not os.path.exists(self.scales_dir):
             self.fail("Test WAV files are missing. Please generate them first.")
 
-    # Normalize the output by stripping whitespace and removing newlines
-    def run_detector(self, file_path):
-        """Run the music_key_detector script on a file and return the detected key or mode."""
-    
-        command = ['python3', self.script, file_path, '--plot', 'file.png']
-        result = run(command, stdout=PIPE, stderr=PIPE, text=True)
-        if result.returncode != 0:
-            self.fail(f"Detector script failed with error: {result.stderr}")
-        
-        # Look for either 'Detected Key:' or 'Detected Mode:' in the output
-        lines = result.stdout.strip().split("\n")
-        for line in lines:
-            if "Detected Key:" in line or "Detected Mode:" in line:
-                return line.strip()
-        
-        self.fail("No 'Detected Key:' or 'Detected Mode:' line found in script output.")
+        # Plots are saved to a temporary directory
+        plot_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(plot_dir.cleanup)
+        self.plot_name = os.path.join(plot_dir.name, "file.png")
+
+    def run_detector(self, file_path, **options):
+        """Run key detection in-process on a file and return the detected key or mode."""
+        with redirect_stdout(io.StringIO()):
+            return detect_key(file_path, plot=self.plot_name, **options)
+
+    def assert_same_results(self, **options):
+        """Check that detect_key(**options) matches the default path on every bundled WAV."""
+        file_paths = ([os.path.join(self.tones_dir, f) for f in TONE_RESULTS] +
+                      [os.path.join(self.scales_dir, f) for f in SCALE_RESULTS])
+        for file_path in file_paths:
+            with self.subTest(file=file_path):
+                self.assertEqual(self.run_detector(file_path, **options), self.run_detector(file_path))
     
     def test_single_tones(self):
         """Test key detection for isolated tones."""
-        expected_results = {
-            "A#.wav": "Detected Key: A# (Single Tone)",
-            "G#.wav": "Detected Key: G# (Single Tone)",
-            "C#.wav": "Detected Key: C# (Single Tone)",
-            "D.wav": "Detected Key: D (Single Tone)",
-            "F#.wav": "Detected Key: F# (Single Tone)",
-            "G.wav": "Detected Key: G (Single Tone)",
-            "A.wav": "Detected Key: A (Single Tone)",
-            "B.wav": "Detected Key: B (Single Tone)",
-            "F.wav": "Detected Key: F (Single Tone)",
-            "E.wav": "Detected Key: E (Single Tone)",
-            "C.wav": "Detected Key: C (Single Tone)",
-            "D#.wav": "Detected Key: D# (Single Tone)",
-        }
-        for note_file, expected_output in expected_results.items():
+        for note_file, expected_output in TONE_RESULTS.items():
             with self.subTest(note=note_file):
                 file_path = os.path.join(self.tones_dir, note_file)
                 detected_output = self.run_detector(file_path)
@@ -55,20 +79,7 @@ class TestMusicKeyDetector(unittest.TestCase):
 
     def test_keys_and_modes(self):
         """Test key detection for keys."""
-        expected_results = {
-            # Keys
-            "C_Major.wav": "Detected Key: C Major",
-            "C_Natural Minor.wav": "Detected Key: C Natural Minor",
-            "C_Harmonic Minor.wav": "Detected Key: C Harmonic Minor",
-            "C_Melodic Minor.wav": "Detected Key: C Melodic Minor",
-            # Modes
-            "C_Dorian.wav": "Detected Mode: C Dorian",
-            "C_Phrygian.wav": "Detected Mode: C Phrygian",
-            "C_Lydian.wav": "Detected Mode: C Lydian",
-            "C_Mixolydian.wav": "Detected Mode: C Mixolydian",
-            "C_Locrian.wav": "Detected Mode: C Locrian"
-        }
-        for scale_file, expected_output in expected_results.items():
+        for scale_file, expected_output in SCALE_RESULTS.items():
             with self.subTest(key=scale_file):
                 file_path = os.path.join(self.scales_dir, scale_file)
                 detected_output = self.run_detector(file_path)
@@ -78,5 +89,69 @@ class TestMusicKeyDetector(unittest.TestCase):
                     f"Output for {scale_file} was {detected_output}, expected {expected_output}."
                 )
 
+    def test_downsample_matches_full_rate(self):
+        """Test that analysing at 11025 Hz detects the same keys as the full sample rate."""
+        self.assert_same_results(downsample=True)
+
+    def test_24_bit_wav(self):
+        """Test key detection for a 24-bit PCM WAV, which SciPy cannot memory-map."""
+        file_path = os.path.join(os.path.dirname(self.plot_name), "A_24bit.wav")
+        sample_rate = 44100
+        t = np.arange(2 * sample_rate) / sample_rate
+        sf.write(file_path, 0.5 * np.sin(2 * np.pi * 440 * t), sample_rate, subtype='PCM_24')
+        options = [{}, {"downsample": True}]
+        if njit is not None:
+            options.append({"jit": True})
+        for option in options:
+            with self.subTest(**option):
+                self.assertEqual(self.run_detector(file_path, **option), "Detected Key: A (Single Tone)")
+
+    @unittest.skipIf(njit is None, "numba and rocket-fft are not installed")
+    def test_jit_matches_batched(self):
+        """Test that the Numba STFT kernel detects the same keys as the batched FFT."""
+        self.assert_same_results(jit=True)
+
+    def test_magnitude_spectrum_blocks(self):
+        """Test the blocked STFT against a per-window loop with multiple and partial blocks."""
+        window_size, step_size, num_windows = 4096, 2048, 700
+        self.assertGreater(num_windows, 2 * FRAMES_PER_BLOCK)
+        self.assertNotEqual(num_windows % FRAMES_PER_BLOCK, 0)
+        rng = np.random.default_rng(0)
+        data = rng.standard_normal(window_size + num_windows * step_size).astype(np.float32)
+        window = np.hanning(window_size).astype(np.float32)
+
+        expected = np.zeros(window_size // 2 + 1)
+        for start in range(0, len(data) - window_size, step_size):
+            expected += np.abs(np.fft.rfft(data[start:start + window_size] * window))
+
+        for bins in [slice(None), slice(2, 465)]:
+            with self.subTest(bins=bins):
+                np.testing.assert_allclose(
+                    compute_magnitude_spectrum(data, window, step_size, bins),
+                    expected[bins], rtol=1e-4)
+
+    def test_profiles_file_up_to_date(self):
+        """Test that the shipped profiles.npy matches the scale definitions."""
+        np.testing.assert_array_equal(
+            np.load(PROFILES_FILE),
+            build_profile_matrix(),
+            "profiles.npy is stale. Regenerate it with 'python3 build_profiles.py'."
+        )
+
+    def test_profiles_file_fallback(self):
+        """Test that a corrupt or mismatched profiles.npy is rebuilt instead of failing."""
+        profiles_dir = os.path.dirname(self.plot_name)
+        truncated = os.path.join(profiles_dir, "truncated.npy")
+        with open(PROFILES_FILE, "rb") as src, open(truncated, "wb") as dst:
+            dst.write(src.read()[:100])
+        wrong_dtype = os.path.join(profiles_dir, "float64.npy")
+        np.save(wrong_dtype, build_profile_matrix().astype(np.float64))
+        for path in [truncated, wrong_dtype, os.path.join(profiles_dir, "missing.npy")]:
+            with self.subTest(file=os.path.basename(path)):
+                with mock.patch.object(music_key_detector, "PROFILES_FILE", path):
+                    matrix = music_key_detector.load_profile_matrix()
+                self.assertEqual(matrix.dtype, np.float32)
+                np.testing.assert_array_equal(matrix, build_profile_matrix())
+
 if __name__ == "__main__":
     unittest.main()